@@ -1,7 +1,19 @@
+import tempfile
+
 import streamlit as st
 import pandas as pd
 import numpy as np
 from io import BytesIO
+from collections import defaultdict, deque
+
+from joblib import Parallel, delayed
+
+try:
+    from numba import njit, types
+    from numba.typed import Dict, List
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
 
 # Page configuration
 st.set_page_config(
@@ -33,123 +45,242 @@ with st.sidebar:
     """)
 
 
+# Columns the app actually uses; anything else in the sheet is skipped at read time
+_USED_COLUMNS = ('asesor', 'TotalFac', 'Identificacion', 'producto', 'Cantidad')
+
+# Characters Excel does not allow in sheet names, mapped to '_' in one pass
+_INVALID_SHEET_CHARS = str.maketrans({c: '_' for c in '/\\?*[]:'})
+
+
+@st.cache_data
+def load_excel(file_bytes):
+    """
+    Parse the uploaded Excel bytes into a DataFrame, reading only the
+    columns the app uses. Also returns the file's full column list, so
+    validation errors can show what the sheet actually contains even
+    though the frame itself is narrowed. Cached on the file content so
+    widget interactions don't re-parse the same upload.
+    """
+    # Sniff the header first so wide sheets only pay for the needed columns
+    header = pd.read_excel(BytesIO(file_bytes), engine='calamine', nrows=0)
+    file_columns = header.columns.tolist()
+    usecols = [col for col in _USED_COLUMNS if col in file_columns]
+
+    if not usecols:
+        # Nothing recognizable: load everything
+        df = pd.read_excel(BytesIO(file_bytes), engine='calamine', dtype_backend='pyarrow')
+    else:
+        # Arrow-backed columns keep strings in contiguous buffers instead
+        # of one Python object per cell
+        df = pd.read_excel(
+            BytesIO(file_bytes), engine='calamine', usecols=usecols, dtype_backend='pyarrow'
+        )
+
+    return df, file_columns
+
+
+if _NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _pair_reversals(ids, totals):
+        """
+        Walk the rows once pairing each negative TotalFac with the first
+        unmatched positive entry sharing (Identificacion code, abs(TotalFac)).
+        Amounts are keyed as integer cents to avoid float equality issues;
+        rows with a missing Identificacion (code -1) never match, mirroring
+        NaN equality. Returns a boolean mask of rows to remove.
+        """
+        n = ids.shape[0]
+        remove = np.zeros(n, dtype=np.bool_)
+
+        # (id code, cents) -> list of positive row positions, in row order
+        buckets = Dict.empty(
+            key_type=types.UniTuple(types.int64, 2),
+            value_type=types.ListType(types.int64),
+        )
+        # How many entries of each bucket have already been consumed
+        consumed = Dict.empty(
+            key_type=types.UniTuple(types.int64, 2),
+            value_type=types.int64,
+        )
+
+        for i in range(n):
+            if ids[i] >= 0 and totals[i] >= 0:
+                key = (ids[i], np.int64(round(totals[i] * 100.0)))
+                if key not in buckets:
+                    positions = List.empty_list(types.int64)
+                    buckets[key] = positions
+                    consumed[key] = 0
+                buckets[key].append(i)
+
+        for i in range(n):
+            if ids[i] >= 0 and totals[i] < 0:
+                key = (ids[i], np.int64(round(-totals[i] * 100.0)))
+                if key in buckets:
+                    used = consumed[key]
+                    positions = buckets[key]
+                    if used < len(positions):
+                        remove[positions[used]] = True
+                        remove[i] = True
+                        consumed[key] = used + 1
+
+        return remove
+else:
+    def _pair_reversals(ids, totals):
+        """
+        Pure-Python fallback with the same first-match semantics as the
+        compiled kernel: one pass filling a deque of positive positions
+        per (Identificacion code, cents) key, one pass popping the oldest
+        match for each negative, so every lookup is O(1). Rows with a
+        missing Identificacion (code -1) never match, mirroring NaN equality.
+        """
+        remove = np.zeros(len(ids), dtype=np.bool_)
+        buckets = defaultdict(deque)
+
+        for i, total in enumerate(totals):
+            if ids[i] >= 0 and total >= 0:
+                buckets[(ids[i], round(total * 100.0))].append(i)
+
+        for i, total in enumerate(totals):
+            if ids[i] >= 0 and total < 0:
+                positions = buckets.get((ids[i], round(-total * 100.0)))
+                if positions:
+                    remove[positions.popleft()] = True
+                    remove[i] = True
+
+        return remove
+
+
+@st.cache_data
 def process_reversals(df):
     """
     Process negative TotalFac values by matching them with positive entries
     that have the same Identificacion and same absolute TotalFac value.
     Each pair is removed once.
     """
-    # Create a copy to avoid modifying the original
-    df_processed = df.copy()
-    
-    # Find negative TotalFac entries
-    negative_mask = df_processed['TotalFac'] < 0
-    negative_df = df_processed[negative_mask].copy()
-    positive_df = df_processed[~negative_mask].copy()
-    
-    # Track indices to remove
-    indices_to_remove = set()
-    
-    # Process each negative entry
-    for idx, neg_row in negative_df.iterrows():
-        # Skip if already processed
-        if idx in indices_to_remove:
-            continue
-            
-        neg_identificacion = neg_row['Identificacion']
-        neg_total_abs = abs(neg_row['TotalFac'])
-        
-        # Find matching positive entry with same Identificacion and same absolute TotalFac
-        matching_positive = positive_df[
-            (positive_df['Identificacion'] == neg_identificacion) &
-            (positive_df['TotalFac'] == neg_total_abs)
-        ]
-        
-        if not matching_positive.empty:
-            # Get the first matching positive entry
-            pos_idx = matching_positive.index[0]
-            
-            # Mark both for removal
-            indices_to_remove.add(idx)
-            indices_to_remove.add(pos_idx)
-            
-            # Remove from positive_df to avoid matching it again
-            positive_df = positive_df.drop(pos_idx)
-    
-    # Remove all matched pairs
-    df_processed = df_processed.drop(indices_to_remove)
-    
-    return df_processed, len(indices_to_remove)
+    if len(df) == 0:
+        return df.copy(), 0
+
+    # Factorize Identificacion so the kernel only sees numeric arrays
+    id_codes, _ = pd.factorize(df['Identificacion'])
+    totals = df['TotalFac'].to_numpy(dtype=np.float64)
+
+    # The kernel works on positional indices, so the surviving rows can be
+    # taken with a single boolean selection - no upfront copy, no .drop()
+    remove_mask = _pair_reversals(id_codes.astype(np.int64), totals)
+    df_processed = df.iloc[~remove_mask].reset_index(drop=True)
+
+    return df_processed, int(remove_mask.sum())
+
+
+def _apply_rates(summary):
+    """
+    Add tasa_comision and comision to an aggregated summary:
+    0.5% below 3 facturas, 1% from 3 up, as one branchless expression.
+    """
+    num_facturas = summary['num_facturas'].to_numpy()
+    summary['tasa_comision'] = 0.5 + 0.5 * (num_facturas >= 3)
+    summary['comision'] = (
+        summary['total_ventas'].to_numpy() * summary['tasa_comision'].to_numpy() * 0.01
+    )
+    return summary
 
 
+@st.cache_data
 def calculate_commissions(df):
     """
     Calculate commissions per sales person (asesor)
     - Less than 3 sales: 0.5% commission
     - 3 or more sales: 1% commission
     """
-    # Group by asesor and calculate totals
-    commission_summary = df.groupby('asesor').agg({
-        'TotalFac': ['sum', 'count'],
-        'Identificacion': 'nunique'
-    }).reset_index()
-    
-    # Flatten column names
-    commission_summary.columns = ['asesor', 'total_ventas', 'num_facturas', 'clientes_unicos']
-    
+    # Factorize asesor once and aggregate with bincount on the integer
+    # codes, bypassing the general groupby.agg machinery entirely
+    asesor_codes, asesores = pd.factorize(df['asesor'])
+    n_asesores = len(asesores)
+    valid = asesor_codes >= 0
+
+    if n_asesores == 0:
+        return pd.DataFrame(columns=[
+            'asesor', 'total_ventas', 'num_facturas', 'clientes_unicos',
+            'tasa_comision', 'comision'
+        ])
+
+    # Skip missing TotalFac like groupby's sum/count do: bincount would
+    # otherwise propagate NaN into the sum and count the empty rows
+    totals = df['TotalFac'].to_numpy(dtype=np.float64)
+    amount_valid = valid & ~np.isnan(totals)
+    total_ventas = np.bincount(asesor_codes[amount_valid], weights=totals[amount_valid], minlength=n_asesores)
+    num_facturas = np.bincount(asesor_codes[amount_valid], minlength=n_asesores)
+
+    # Unique clients per asesor: count the distinct (asesor, cliente) code
+    # pairs by packing both factorized codes into a single integer key
+    id_codes, ids = pd.factorize(df['Identificacion'])
+    if len(ids) > 0:
+        pair_valid = valid & (id_codes >= 0)
+        pair_keys = (
+            asesor_codes[pair_valid].astype(np.int64) * np.int64(len(ids))
+            + id_codes[pair_valid]
+        )
+        clientes_unicos = np.bincount(
+            np.unique(pair_keys) // np.int64(len(ids)), minlength=n_asesores
+        )
+    else:
+        clientes_unicos = np.zeros(n_asesores, dtype=np.int64)
+
+    commission_summary = pd.DataFrame({
+        'asesor': np.asarray(asesores),
+        'total_ventas': total_ventas,
+        'num_facturas': num_facturas,
+        'clientes_unicos': clientes_unicos,
+    })
+
     # Apply tiered commission rate based on number of sales
-    commission_summary['tasa_comision'] = commission_summary['num_facturas'].apply(
-        lambda x: 0.5 if x < 3 else 1.0
-    )
-    
-    # Calculate commission
-    commission_summary['comision'] = commission_summary['total_ventas'] * (commission_summary['tasa_comision'] / 100)
-    
+    commission_summary = _apply_rates(commission_summary)
+
     # Sort by total sales descending
     commission_summary = commission_summary.sort_values('total_ventas', ascending=False)
-    
+
     return commission_summary
 
 
+@st.cache_data
 def calculate_commissions_by_product(df):
     """
     Calculate commissions per sales person (asesor) grouped by product (producto)
     Returns a dictionary with product names as keys and commission summaries as values
     """
     commissions_by_product = {}
-    
+
     if 'producto' not in df.columns:
         return commissions_by_product
-    
-    # Get unique products
-    unique_products = df['producto'].dropna().unique()
-    
-    for product in unique_products:
-        # Filter data for this product
-        product_df = df[df['producto'] == product]
-        
-        # Calculate commissions for this product
-        commission_summary = product_df.groupby('asesor').agg({
-            'TotalFac': ['sum', 'count'],
-            'Identificacion': 'nunique'
-        }).reset_index()
-        
-        # Flatten column names
-        commission_summary.columns = ['asesor', 'total_ventas', 'num_facturas', 'clientes_unicos']
-        
-        # Apply tiered commission rate based on number of sales
-        commission_summary['tasa_comision'] = commission_summary['num_facturas'].apply(
-            lambda x: 0.5 if x < 3 else 1.0
+
+    # Aggregate every (producto, asesor) pair in a single groupby pass
+    grouped = df.dropna(subset=['producto']).groupby(
+        ['producto', 'asesor'], sort=False, observed=True
+    ).agg(
+        total_ventas=('TotalFac', 'sum'),
+        num_facturas=('TotalFac', 'count'),
+        clientes_unicos=('Identificacion', 'nunique')
+    ).reset_index()
+
+    # Apply tiered commission rate based on number of sales
+    grouped = _apply_rates(grouped)
+
+    # Split the aggregated frame by product
+    for product, product_summary in grouped.groupby('producto', sort=False, observed=True):
+        commissions_by_product[product] = (
+            product_summary.drop(columns='producto').sort_values('total_ventas', ascending=False)
         )
-        
-        # Calculate commission
-        commission_summary['comision'] = commission_summary['total_ventas'] * (commission_summary['tasa_comision'] / 100)
-        
-        # Sort by total sales descending
-        commission_summary = commission_summary.sort_values('total_ventas', ascending=False)
-        
-        commissions_by_product[product] = commission_summary
-    
+
+    # Products whose rows all lack an asesor drop out of the groupby;
+    # keep an empty summary for them, like the old per-product loop did,
+    # so they still get a (header-only) sheet in the report
+    for product in df['producto'].dropna().unique():
+        if product not in commissions_by_product:
+            commissions_by_product[product] = pd.DataFrame(columns=[
+                'asesor', 'total_ventas', 'num_facturas', 'clientes_unicos',
+                'tasa_comision', 'comision'
+            ])
+
     return commissions_by_product
 
 
@@ -160,8 +291,9 @@ def calculate_units_by_product(df):
     if 'producto' not in df.columns or 'Cantidad' not in df.columns:
         return None
     
-    # Group by product and sum quantities
-    units_by_product = df.groupby('producto')['Cantidad'].sum().reset_index()
+    # Group by product and sum quantities (no key sort - we sort by units
+    # below; observed=True keeps filtered-out categories off the result)
+    units_by_product = df.groupby('producto', sort=False, observed=True)['Cantidad'].sum().reset_index()
     units_by_product.columns = ['Producto', 'Unidades Vendidas']
     
     # Sort by units sold descending
@@ -214,6 +346,90 @@ def calculate_sales_boss_commission(df):
     }
 
 
+def _prepare_product_sheet(product, product_commissions):
+    """
+    Build the (sheet name, formatted frame) pair for one product sheet
+    of the downloadable report.
+    """
+    product_download = product_commissions.copy()
+    product_download.columns = ['Vendedor', 'Total Ventas', 'N° Facturas', 'Clientes Únicos', 'Tasa Comisión', 'Comisión']
+
+    # Clean sheet name (Excel has 31 char limit and some special chars are not allowed)
+    sheet_name = str(product)[:31].translate(_INVALID_SHEET_CHARS)
+
+    return sheet_name, product_download
+
+
+@st.cache_data
+def build_report_bytes(commissions_by_product, commission_summary,
+                       sales_boss_commission, units_by_product, df_processed):
+    """
+    Build the downloadable Excel report and return its bytes. Cached on
+    the inputs, so reruns that don't change the processed data serve the
+    previously generated report for free.
+    """
+    # Convert to Excel - organized by product
+    # (xlsxwriter is lighter than openpyxl's cell-object model; the
+    # spooled file spills to disk once the report outgrows 8 MB.
+    # constant_memory is off: it drops out-of-order writes, and
+    # to_excel fills cells column by column)
+    with tempfile.SpooledTemporaryFile(max_size=8_000_000) as output:
+        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+            # Numeric cell formats so the exported columns stay sortable in Excel
+            money_format = writer.book.add_format({'num_format': '$#,##0.00'})
+            rate_format = writer.book.add_format({'num_format': '0.0"%"'})
+
+            # Commissions by product (separate sheet for each product) - PRIMARY ORGANIZATION
+            if commissions_by_product:
+                # Format the per-product frames in parallel; the writer
+                # itself is not thread-safe, so sheets are written
+                # sequentially afterwards
+                prepared_sheets = Parallel(n_jobs=-1, prefer='threads')(
+                    delayed(_prepare_product_sheet)(product, product_commissions)
+                    for product, product_commissions in commissions_by_product.items()
+                )
+                for sheet_name, product_download in prepared_sheets:
+                    product_download.to_excel(writer, sheet_name=sheet_name, index=False)
+                    worksheet = writer.sheets[sheet_name]
+                    worksheet.set_column(1, 1, 14, money_format)
+                    worksheet.set_column(4, 4, 12, rate_format)
+                    worksheet.set_column(5, 5, 14, money_format)
+            else:
+                # If no product column, create a single sheet with all commissions
+                download_df = commission_summary.copy()
+                download_df.columns = ['Vendedor', 'Total Ventas', 'N° Facturas', 'Clientes Únicos', 'Tasa Comisión', 'Comisión']
+                download_df.to_excel(writer, sheet_name='Comisiones', index=False)
+                worksheet = writer.sheets['Comisiones']
+                worksheet.set_column(1, 1, 14, money_format)
+                worksheet.set_column(4, 4, 12, rate_format)
+                worksheet.set_column(5, 5, 14, money_format)
+
+            # Sales Boss Commission Sheet
+            if sales_boss_commission:
+                boss_info = sales_boss_commission
+                boss_download = pd.DataFrame([{
+                    'Jefe de Ventas': boss_info['nombre'],
+                    'Producto': boss_info['producto'],
+                    'Ventas Realizadas': boss_info['ventas_count'],
+                    'Meta': boss_info['meta'],
+                    '% Logro': f"{boss_info['porcentaje_logro']:.2f}%",
+                    'Total Ventas': boss_info['ventas_value'],
+                    'Tasa Comisión': f"{boss_info['tasa_comision']:.3f}%",
+                    'Comisión': boss_info['comision']
+                }])
+                boss_download.to_excel(writer, sheet_name='Comision Jefe Ventas', index=False)
+
+            # Units sold by product
+            if units_by_product is not None:
+                units_by_product.to_excel(writer, sheet_name='Unidades por Producto', index=False)
+
+            # Processed data
+            df_processed.to_excel(writer, sheet_name='Datos Procesados', index=False)
+
+        output.seek(0)
+        return output.read()
+
+
 # File upload
 uploaded_file = st.file_uploader(
     "Subir archivo Excel (.xlsx)",
@@ -223,9 +439,10 @@ uploaded_file = st.file_uploader(
 
 if uploaded_file is not None:
     try:
-        # Read Excel file
+        # Read Excel file (calamine streams the sheet instead of building
+        # openpyxl's full DOM; columns come back Arrow-backed, not object)
         with st.spinner("Leyendo archivo Excel..."):
-            df = pd.read_excel(uploaded_file)
+            df, file_columns = load_excel(uploaded_file.getvalue())
         
         st.success(f"✅ Archivo cargado exitosamente. {len(df)} registros encontrados.")
         
@@ -236,15 +453,23 @@ if uploaded_file is not None:
         if missing_columns:
             st.error(f"❌ Faltan las siguientes columnas requeridas: {', '.join(missing_columns)}")
             st.info("Columnas disponibles en el archivo:")
-            st.write(df.columns.tolist())
+            st.write(file_columns)
         else:
+            # Categorize the low-cardinality columns so downstream groupbys
+            # bucket integer codes; Identificacion stays an Arrow-backed
+            # string, since its cardinality is too high for category to pay off
+            for col in ('asesor', 'producto'):
+                if col in df.columns and df[col].dtype != 'category':
+                    df[col] = df[col].astype('category')
+
             # Product filter
             if 'producto' in df.columns:
                 st.markdown("---")
                 st.subheader("🔍 Filtro por Producto")
                 
-                # Get unique products
-                unique_products = sorted(df['producto'].dropna().unique().tolist())
+                # Get unique products - the categorical already holds the
+                # sorted uniques, so no full-column scan is needed
+                unique_products = df['producto'].cat.categories.tolist()
                 
                 if len(unique_products) > 0:
                     selected_products = st.multiselect(
@@ -254,9 +479,12 @@ if uploaded_file is not None:
                         help="Seleccione uno o más productos para filtrar las ventas. Si no selecciona ninguno, se incluirán todos los productos."
                     )
                     
-                    # Apply product filter
+                    # Apply product filter on the integer category codes
+                    # instead of hashing the string values row by row
                     if len(selected_products) > 0:
-                        df = df[df['producto'].isin(selected_products)]
+                        selected_codes = df['producto'].cat.categories.get_indexer(selected_products)
+                        mask = np.isin(df['producto'].cat.codes.to_numpy(), selected_codes)
+                        df = df[mask]
                         st.info(f"📦 Filtrando por {len(selected_products)} producto(s) seleccionado(s). {len(df)} registros después del filtro.")
                     # If no products selected, include all (no filter applied)
                 else:
@@ -330,15 +558,18 @@ if uploaded_file is not None:
             # Display commission table
             st.subheader("💼 Detalle de Comisiones")
             
-            # Format the dataframe for display
-            display_df = commission_summary.copy()
-            display_df['total_ventas'] = display_df['total_ventas'].apply(lambda x: f"${x:,.2f}")
-            display_df['tasa_comision'] = display_df['tasa_comision'].apply(lambda x: f"{x}%")
-            display_df['comision'] = display_df['comision'].apply(lambda x: f"${x:,.2f}")
-            display_df.columns = ['Vendedor', 'Total Ventas', 'N° Facturas', 'Clientes Únicos', 'Tasa Comisión', 'Comisión']
-            
+            # Let Streamlit format the numeric columns client-side instead of
+            # pre-formatting every cell to strings with .apply
             st.dataframe(
-                display_df,
+                commission_summary,
+                column_config={
+                    'asesor': st.column_config.TextColumn('Vendedor'),
+                    'total_ventas': st.column_config.NumberColumn('Total Ventas', format='$%.2f'),
+                    'num_facturas': st.column_config.NumberColumn('N° Facturas'),
+                    'clientes_unicos': st.column_config.NumberColumn('Clientes Únicos'),
+                    'tasa_comision': st.column_config.NumberColumn('Tasa Comisión', format='%.1f%%'),
+                    'comision': st.column_config.NumberColumn('Comisión', format='$%.2f'),
+                },
                 use_container_width=True,
                 hide_index=True
             )
@@ -393,56 +624,15 @@ if uploaded_file is not None:
             st.markdown("---")
             st.subheader("💾 Exportar Resultados")
             
-            # Convert to Excel - organized by product
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                # Commissions by product (separate sheet for each product) - PRIMARY ORGANIZATION
-                if commissions_by_product:
-                    for product, product_commissions in commissions_by_product.items():
-                        # Format product commission data
-                        product_download = product_commissions.copy()
-                        product_download['tasa_comision'] = product_download['tasa_comision'].apply(lambda x: f"{x}%")
-                        product_download.columns = ['Vendedor', 'Total Ventas', 'N° Facturas', 'Clientes Únicos', 'Tasa Comisión', 'Comisión']
-                        
-                        # Clean sheet name (Excel has 31 char limit and some special chars are not allowed)
-                        sheet_name = str(product)[:31]
-                        sheet_name = sheet_name.replace('/', '_').replace('\\', '_').replace('?', '_').replace('*', '_').replace('[', '_').replace(']', '_').replace(':', '_')
-                        
-                        product_download.to_excel(writer, sheet_name=sheet_name, index=False)
-                else:
-                    # If no product column, create a single sheet with all commissions
-                    download_df = commission_summary.copy()
-                    download_df['tasa_comision'] = download_df['tasa_comision'].apply(lambda x: f"{x}%")
-                    download_df.columns = ['Vendedor', 'Total Ventas', 'N° Facturas', 'Clientes Únicos', 'Tasa Comisión', 'Comisión']
-                    download_df.to_excel(writer, sheet_name='Comisiones', index=False)
-                
-                # Sales Boss Commission Sheet
-                if sales_boss_commission:
-                    boss_info = sales_boss_commission
-                    boss_download = pd.DataFrame([{
-                        'Jefe de Ventas': boss_info['nombre'],
-                        'Producto': boss_info['producto'],
-                        'Ventas Realizadas': boss_info['ventas_count'],
-                        'Meta': boss_info['meta'],
-                        '% Logro': f"{boss_info['porcentaje_logro']:.2f}%",
-                        'Total Ventas': boss_info['ventas_value'],
-                        'Tasa Comisión': f"{boss_info['tasa_comision']:.3f}%",
-                        'Comisión': boss_info['comision']
-                    }])
-                    boss_download.to_excel(writer, sheet_name='Comision Jefe Ventas', index=False)
-                
-                # Units sold by product
-                if units_by_product is not None:
-                    units_by_product.to_excel(writer, sheet_name='Unidades por Producto', index=False)
-                
-                # Processed data
-                df_processed.to_excel(writer, sheet_name='Datos Procesados', index=False)
-            
-            output.seek(0)
-            
+            # Build (or reuse the cached) Excel report
+            report_bytes = build_report_bytes(
+                commissions_by_product, commission_summary,
+                sales_boss_commission, units_by_product, df_processed
+            )
+
             st.download_button(
                 label="📥 Descargar Reporte Excel",
-                data=output,
+                data=report_bytes,
                 file_name="reporte_comisiones.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )